@@ -1,12 +1,31 @@
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
 import csv
 import datetime
+from itertools import accumulate, groupby, islice, repeat
 import json
 import logging
 import math
+from operator import add, itemgetter
 import os
+import random
 import requests
+from requests.adapters import HTTPAdapter
 import time
-import urllib.parse
+
+try:
+    # orjson parses the response bytes several times faster than the json module.
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    # Optional, used by interpolate() to compile the daily min/max loop.
+    import numba
+    import numpy
+except ImportError:
+    numba = None
 
 PRODUCT_CSV = {
     'AMAZON': 0,            # Amazon price history
@@ -67,29 +86,84 @@ STATUS_CODES = {
     500: 'An unexpected error occurred when executing this request.',
 }
 
+KEEPA_EPOCH = 21564000 * 60  # Unix timestamp of 2011-01-01 00:00 UTC, KeepaTime is minutes since then.
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+ONE_DAY = datetime.timedelta(days=1)
+
 logger = logging.getLogger(__name__)
 
 
+def _formatted_iter(csv_data, mintime=0):
+    """ Lazy formatted(): iterator over the (timestamp, value) pairs, the list is never built."""
+    i = 0
+    if mintime:
+        # Compare in KeepaTime so only the kept points need to be converted. KeepaTime is stored unboxed as int64,
+        # bisect works on the array directly. Times are sorted, so the array is only filled, in blocks, until it
+        # passes keepa_mintime.
+        keepa_mintime = (mintime - KEEPA_EPOCH) // 60
+        times = islice(csv_data, 0, None, 2)
+        keepa_times = array('q')
+        while not keepa_times or keepa_times[-1] <= keepa_mintime:
+            size = len(keepa_times)
+            keepa_times.extend(islice(times, 1024))
+            if len(keepa_times) == size:
+                break
+        i = max(bisect_right(keepa_times, keepa_mintime) - 1, 0)
+    # Pair (time, value) in a single pass over csv_data instead of slicing it twice.
+    data = islice(csv_data, 2*i, None)
+    return ((t*60 + KEEPA_EPOCH, v) for t, v in zip(data, data))
+
+
 def formatted(csv_data, mintime=0):
     """ Tranlaste KeepaTime to timestamp and save as ((timestamp1, value1), ... (timestampN, valueN))."""
     if not csv_data:
         return tuple()
-    timestamps = [(t + 21564000)*60 for t in csv_data[0::2]]
-    values = csv_data[1::2]
-    i = 0
-    if mintime:
-        for i, timestamp in enumerate(timestamps):
-            if timestamp > mintime:
-                break
-        i = (i - 1) if i else 0
-    return list(zip(timestamps[i:], values[i:]))
+    return list(_formatted_iter(csv_data, mintime))
 
 
 def gmdate(timestamp):
     """ Return GMT/UTC date(YY.mm.dd) correcponding to timestamp."""
-    date = time.strftime('%Y.%m.%d', time.gmtime(timestamp))
-    args = [int(v) for v in date.split('.')]
-    return datetime.date(*args)
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).date()
+
+
+def _daily_dates(first_day, count):
+    """ List of count consecutive datetime.date objects starting from the day ordinal first_day."""
+    # Stepping by a day is much cheaper than datetime.date.fromordinal() for every day.
+    return list(accumulate(repeat(ONE_DAY, count - 1), add, initial=datetime.date.fromordinal(first_day)))
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _interpolate_days(days, values, today, use_max):
+        """ Daily min/max of values grouped by sorted day ordinals, from days[0] to today."""
+        first_day = days[0]
+        results = numpy.empty(today - first_day + 1, numpy.int64)
+        i = 0
+        value = values[0]
+        for k in range(results.shape[0]):
+            day = first_day + k
+            if i < days.shape[0] and days[i] == day:
+                value = values[i]
+                i += 1
+                while i < days.shape[0] and days[i] == day:
+                    value = max(value, values[i]) if use_max else min(value, values[i])
+                    i += 1
+            results[k] = value
+        return results
+
+
+def _interpolate_numba(csv_data, func):
+    """ interpolate() for func in (min, max) on integer CSV data, None if the data can't be handled."""
+    data = numpy.asarray(csv_data)
+    if data.ndim != 1 or data.dtype.kind != 'i' or len(data) < 2:
+        return None
+    values = data[1::2]
+    days = (data[0::2][:len(values)]*60 + KEEPA_EPOCH) // 86400 + EPOCH_ORDINAL
+    today = datetime.date.today().toordinal()
+    if days[0] > today:
+        return []
+    results = _interpolate_days(days, values, today, func is max)
+    return list(zip(_daily_dates(int(days[0]), len(results)), results.tolist()))
 
 
 def interpolate(csv_data, func=min):
@@ -98,54 +172,63 @@ def interpolate(csv_data, func=min):
     :param csv_data: Raw CSV data from Keepa
     :param func: The function which will use to calculate daily value if two or more values are available this day.
     """
-    results = []
-    data = iter(formatted(csv_data))
-    try:
-        timestamp1, value1 = next(data)
-    except StopIteration:
-        return results
-    date1 = gmdate(timestamp1)
-    date2, value2 = date1, value1
-    today = datetime.date.today()
-    day = datetime.timedelta(days=1)
-    while date1 <= today:
-        if date1 == date2:
-            values = [value2]
-            while True:
-                try:
-                    timestamp2, value2 = next(data)
-                except StopIteration:
-                    break
-                date2 = gmdate(timestamp2)
-                if date1 == date2:
-                    values.append(value2)
-                else:
-                    break
-            value1 = func(values)
-        results.append((date1, value1))
-        date1 = date1 + day
-    return results
+    if not csv_data:
+        return []
+    if numba is not None and (func is min or func is max):
+        results = _interpolate_numba(csv_data, func)
+        if results is not None:
+            return results
+    # Each timestamp is converted to its GMT/UTC date ordinal once, so grouping only compares ints.
+    days = groupby(((ts // 86400 + EPOCH_ORDINAL, v) for ts, v in _formatted_iter(csv_data)), key=itemgetter(0))
+    today = datetime.date.today().toordinal()
+    values = []
+    first_day = last_day = value = None
+    for day, day_points in days:
+        if day > today:
+            break
+        if last_day is None:
+            first_day = day
+        else:
+            # Days without data keep the previous day's value.
+            values.extend([value] * (day - last_day - 1))
+        value = func([v for _, v in day_points])
+        values.append(value)
+        last_day = day
+    if last_day is None:
+        return []
+    values.extend([value] * (today - last_day))
+    return list(zip(_daily_dates(first_day, len(values)), values))
+
+
+def _excerpt(response, size=256):
+    """ Beginning of the response body for logging, without decoding the whole body via response.text."""
+    return response.content[:size].decode('utf-8', 'replace')
 
 
 def save2csv(filepath, rows):
-    with open(filepath, 'w', encoding='utf8') as f:
+    with open(filepath, 'w', encoding='utf8', newline='', buffering=1 << 20) as f:
         writer = csv.writer(f, lineterminator='\n', quoting=csv.QUOTE_MINIMAL)
-        for row in rows:
-            writer.writerow(row)
+        writer.writerows(rows)
 
 
 class KeepaAPI:
     """ How to make Requests: https://keepa.com/#!discuss/t/how-to-make-requests/767 """
 
-    def __init__(self, key, domain=DOMAINS['com']):
+    def __init__(self, key, domain=DOMAINS['com'], timeout=(5, 30)):
         """
         :param key: API access key.
         :param domain: Integer value for the Amazon locale you want to access. Valid values: DOMAINS.values()
+        :param timeout: Connect and read timeouts in seconds passed to every request.
         """
         self.key = key
         self.domain = domain
+        self.timeout = timeout
+        self.base_url = 'https://api.keepa.com'
         self.messages = []
         self.response = None
+        # Keep-alive connections are reused between requests instead of a new TLS handshake for every call.
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0))
 
     def best_sellers(self, category, domain=None):
         """
@@ -170,19 +253,19 @@ class KeepaAPI:
         :return: The response contains a categories and, if the parents parameter was 1, a categoryParents field with
             all category objects found on the way to the tree's root.
         """
-        if type(category) is str:
-            cat_ids = category.split(',')
-            assert len(category) <= 10, 'Error: More then 10 category ids.'
-        elif type(category) is int:
-            cat_ids = [str(category)]
-        elif type(category) is list:
-            cat_ids = [str(cat_id) for cat_id in category]
+        if isinstance(category, str):
+            cat_ids = category  # Already comma separated.
+        elif isinstance(category, int) and not isinstance(category, bool):
+            cat_ids = str(category)
+        elif isinstance(category, (list, tuple, set)):
+            cat_ids = ','.join(map(str, category))
         else:
             raise KeepaException('Incorrect category type.')
+        assert cat_ids.count(',') < 10, 'Error: More then 10 category ids.'
         query = {
             'key': self.key,
             'domain': domain or self.domain,
-            'category': ','.join(cat_ids),
+            'category': cat_ids,
         }
         if parents:
             query['parents'] = parents
@@ -220,6 +303,19 @@ class KeepaAPI:
             query['offers'] = str(int(offers))
         return self.request('/product', query)
 
+    def products_many(self, asins, max_workers=8, **kwargs):
+        """
+        Request any number of products in batches of 100 ASINs sent concurrently over the pooled session.
+        :param asins: The list of ASINs of the products you want to request.
+        :param max_workers: The maximum number of batches requested at the same time.
+        :param kwargs: Any other parameters accepted by products().
+        :return: List of products() responses, one per batch, in the order of asins.
+        """
+        assert type(asins) is list, 'Param "asins" type must be a "list"'
+        batches = [asins[i:i + 100] for i in range(0, len(asins), 100)]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda batch: self.products(batch, **kwargs), batches))
+
     def sellers(self, seller_ids, storefront=False, update=None, domain=None):
         """
         How to request seller information: https://keepa.com/#!discuss/t/request-seller-information/790
@@ -246,34 +342,38 @@ class KeepaAPI:
 
     def request(self, path, query):
         """ Make request to Keepa API and return data in json format."""
-        url = urllib.parse.urlunparse(('https', 'api.keepa.com', path, '', urllib.parse.urlencode(query), ''))
+        url = self.base_url + path
         while True:
             counter = 3
             while True:
                 try:
-                    self.response = requests.get(url)
-                    logger.info('GET {}'.format(url))
-                    data = json.loads(self.response.text)
+                    response = self.response = self.session.get(url, params=query, timeout=self.timeout)
+                    logger.info('GET {}'.format(response.url))
+                    data = json_loads(response.content)
                     break
-                except (requests.exceptions.ConnectionError, json.decoder.JSONDecodeError) as e:
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                        json.decoder.JSONDecodeError) as e:
                     logger.warning('Exception: "{}". counter = "{}"'.format(e, counter))
                     counter -= 1
                     if not counter:
                         raise
-                    time.sleep(30)
-            if self.response.status_code == 200:
+                    # Exponential backoff with jitter: about 2 and 4 seconds before the 2nd and 3rd attempts.
+                    time.sleep(min(2 ** (3 - counter), 30) + random.uniform(0, 0.5))
+            if response.status_code == 200:
                 break
-            elif self.response.status_code in STATUS_CODES:
-                if self.response.status_code == 429:
+            elif response.status_code in STATUS_CODES:
+                if response.status_code == 429:
                     delay = math.ceil(data['refillIn']/1000)
                     logger.info('Tokens left {}. Sleep {} sec.'.format(data['tokensLeft'], delay))
                     time.sleep(delay)
                 else:
-                    error = STATUS_CODES[self.response.status_code]
-                    logger.error(error)
+                    error = STATUS_CODES[response.status_code]
+                    logger.error('{} Response: {}'.format(error, _excerpt(response)))
                     raise KeepaException(error)
             else:
-                raise KeepaException('Unknown status code "{}"'.format(self.response.status_code))
+                error = 'Unknown status code "{}"'.format(response.status_code)
+                logger.error('{} Response: {}'.format(error, _excerpt(response)))
+                raise KeepaException(error)
         return data
 
     def token_status(self):